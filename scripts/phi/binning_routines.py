@@ -1,11 +1,27 @@
 import numpy as np
 import pandas as pd
-from itertools import chain
-from scipy import optimize
+from scipy.special import lambertw
 
+# Solver used by optim, one of 'closed_form', 'brentq' and 'nelder-mead' (the latter two for validation)
+SOLVER = 'closed_form'
+
+
+def residual(x, n_haplo, n_mut):
+  """Residual of the number of haplotypes, which is zero for the optimal value of phi.
+
+  :param x: The parameter to be fitted.
+  :type x: float
+  :param n_haplo: Number of haplotypes.
+  :type n_haplo: int
+  :param n_mut: Number of mutant sequences.
+  :type n_mut: int
+  :returns: The residual with the given parameters.
+  :rtype: float
+  """
+  return n_haplo - x*np.log1p(n_mut/x)
 
 def get_phi(x, n_haplo, n_mut):
-  """Objective function to be minimised inferring the optimal value for phi.
+  """Objective function to be minimised inferring the optimal value for phi (the squared residual, kept for the solver 'nelder-mead').
 
   :param x: The parameter to be minimised.
   :type x: float
@@ -16,26 +32,59 @@ def get_phi(x, n_haplo, n_mut):
   :returns: The result of the objective function with the given parameters.
   :rtype: float
   """
-  return (n_haplo-(x*np.log(1+n_mut/x)))**2 
+  return residual(x, n_haplo, n_mut)**2
 
-def optim(n_haplo, n_mut):
+def optim(n_haplo, n_mut, solver=None):
   """
-  Optimise function, calling the scipy optimizer with metheod "Nelder-Mead".
+  Infer the optimal value for phi, by default solving the objective function in closed form.
+
+  Substituting u = n_mut/x, the root of the objective satisfies log(1+u)/u = r with r = n_haplo/n_mut,
+  which is solved by x = -n_haplo / (W_{-1}(-r*exp(-r)) + r), using the lower branch of the Lambert W function.
+  For r close to 1 the root is taken from its series expansion x = n_mut / (2e + 8/3 e^2 + 28/9 e^3) with e = 1-r.
 
   :param n_haplo: Number of haplotypes.
   :type n_haplo: int
   :param n_mut: Number of mutant sequences.
   :type n_mut: int
+  :param solver: Solver to use instead of SOLVER. 'brentq' finds the root of the residual with scipy's brentq, 
+    bracketed by n_haplo*r/(1-r^2) (from log(1+u) <= u/sqrt(1+u)) and n_haplo*n_mut/(n_mut-n_haplo) (from log(1+u) >= u/(1+u)).
+    'nelder-mead' minimises the objective function with scipy's Nelder-Mead, as originally done.
+  :type solver: str
   :returns: Optimal value of the objective function with the given parameters.
   :rtype: float
   """
 
+  if solver is None:
+      solver = SOLVER
+  if solver not in ('closed_form', 'brentq', 'nelder-mead'):
+      raise ValueError("Unknown solver " + str(solver) + ". Please choose one of closed_form, brentq and nelder-mead!")
+
   # If no data available -- set estimate to zero
   if (n_haplo==0) or (n_mut==0):
       return 0
   # If more haployptes than mutants, no clear answer can be given (very low sampling). Hence not evaluable
   elif n_haplo >= n_mut:
       return np.nan
+  # Solve in closed form
+  elif solver == 'closed_form':
+      r = n_haplo/n_mut
+      # If almost as many haplotypes as mutants, W_{-1} would be evaluated too close to its branch point.
+      # Use the series expansion of the root in e = 1-r instead
+      if r > 1 - 1e-4:
+          e = 1 - r
+          return n_mut/(2*e + 8/3*e**2 + 28/9*e**3)
+      w = lambertw(-r*np.exp(-r), k=-1)
+      return -n_haplo/np.real(w+r)
+
+  # scipy.optimize is only needed for validation
+  from scipy import optimize
+  # Find the root with brentq
+  if solver == 'brentq':
+      r = n_haplo/n_mut
+      lower = n_haplo*r/(1-r*r)
+      upper = n_haplo*n_mut/(n_mut-n_haplo)
+      # tolerance relative to the bracket, as phi can be very small
+      return optimize.brentq(residual, lower, upper, args=(n_haplo,n_mut), xtol=1e-10*lower)
   # Else optimize with Nelder-Mead
   else:
       x0 = 1
@@ -43,160 +92,225 @@ def optim(n_haplo, n_mut):
       return sol.x[0]
 
 
-def optim_2(n_haplo, n_mut):
+def solve_phi(n_haplo, n_mut, out, iterations=20):
   """
-  Optimise function, calling the scipy optimizer with metheod "L-BFGS-B".
-
-  :param n_haplo: Number of haplotypes.
-  :type n_haplo: int
-  :param n_mut: Number of mutant sequences.
-  :type n_mut: int
-  :returns: Optimal value of the objective function with the given parameters.
-  :rtype: float
+  Solve the root of the objective function x*log(1+n_mut/x) - n_haplo for all bins, running a fixed number of Newton iterations.
+  The iteration only runs on the evaluable bins and reuses its buffers in-place, writing the result into out.
+
+  The iteration starts at the lower bound n_haplo*r/(1-r^2) of the root (r = n_haplo/n_mut). 
+  As the function is increasing and concave in x, Newton's method converges monotonically from there.
+
+  :param n_haplo: Number of haplotypes per bin.
+  :type n_haplo: numpy.ndarray
+  :param n_mut: Number of mutant sequences per bin.
+  :type n_mut: numpy.ndarray
+  :param out: Array of the same size receiving the optimal values.
+  :type out: numpy.ndarray
+  :param iterations: Number of Newton iterations.
+  :type iterations: int
   """
-
   # If no data available -- set estimate to zero
-  if n_haplo==0 or n_mut==0:
-      return 0
   # If more haployptes than mutants, no clear answer can be given (very low sampling). Hence not evaluable
-  elif n_haplo >= n_mut:
-      return np.nan
-  # Else optimize with trust-constr option to keep evaluation in feasible region
-  else:
-      x0 = 1
-      #sol = optimize.minimize(self._fmle, x0=x0, method='trust-constr', args=(nu,ns), constraints=con1)
-      # use least squares without MLE
-      sol = optimize.minimize(get_phi, x0=x0, method='L-BFGS-B', args=(n_haplo,n_mut))
-      return sol.x[0]
+  out[:] = np.where((n_haplo == 0) | (n_mut == 0), 0., np.nan)
+
+  valid = (n_haplo > 0) & (n_mut > 0) & (n_haplo < n_mut)
+  h = n_haplo[valid]
+  m = n_mut[valid]
+
+  x = h/m
+  x *= h/(1-x*x)
+  f = np.empty_like(x)
+  df = np.empty_like(x)
+  for _ in range(iterations):
+    # f = x*log1p(m/x) - h and df = log1p(m/x) - m/(x+m)
+    np.divide(m, x, out=f)
+    np.log1p(f, out=f)
+    np.add(x, m, out=df)
+    np.divide(m, df, out=df)
+    np.subtract(f, df, out=df)
+    f *= x
+    f -= h
+    f /= df
+    x -= f
+
+  out[valid] = x
+
+
+def optim_batch(n_haplo, n_mut, iterations=20):
+  """
+  Infer the optimal values for phi for several bins at once.
+
+  :param n_haplo: Number of haplotypes per bin.
+  :type n_haplo: numpy.ndarray
+  :param n_mut: Number of mutant sequences per bin.
+  :type n_mut: numpy.ndarray
+  :param iterations: Number of Newton iterations.
+  :type iterations: int
+  :returns: Optimal values of the objective function for each bin.
+  :rtype: numpy.ndarray
+  """
+  n_haplo = np.ascontiguousarray(n_haplo, dtype=float)
+  n_mut = np.ascontiguousarray(n_mut, dtype=float)
 
-def optim_3(n_haplo, n_mut):
+  phi = np.empty_like(n_haplo)
+  solve_phi(n_haplo, n_mut, phi, iterations=iterations)
+  return phi
+
+
+def factorize_snvs(haplotypes, haplotype_snvs):
   """
-  Optimise function, calling the scipy optimizer with metheod "trust-constr".
+  Factorize the single SNVs of all sequences to integer codes.
+  The SNV strings are only split once per distinct haplotype, the codes are then expanded to the sequences.
+
+  :param haplotypes: Haplotype code per sequence.
+  :type haplotypes: numpy.ndarray
+  :param haplotype_snvs: SNVs per haplotype code (in string format, separated by blanks).
+  :type haplotype_snvs: array-like
+  :returns: Offsets of the SNVs of each sequence (the SNVs of sequence i are at positions snv_indptr[i] to snv_indptr[i+1]) and the SNV codes.
+  :rtype: tuple(numpy.ndarray, numpy.ndarray)
+  """
+  snv_lists = pd.Series(haplotype_snvs).str.split()
+  snvs_per_haplotype = snv_lists.str.len().values.astype(np.int64)
+  haplotype_indptr = np.zeros(len(snv_lists)+1, dtype=np.int64)
+  np.cumsum(snvs_per_haplotype, out=haplotype_indptr[1:])
+  # haplotypes without SNVs are exploded to NaN, which is dropped again
+  haplotype_snv_types, _ = pd.factorize(snv_lists.explode().dropna())
 
-  :param n_haplo: Number of haplotypes.
-  :type n_haplo: int
-  :param n_mut: Number of mutant sequences.
-  :type n_mut: int
-  :returns: Optimal value of the objective function with the given parameters.
-  :rtype: float
+  # expand the SNV codes of each haplotype to its sequences
+  snvs_per_seq = snvs_per_haplotype[haplotypes]
+  snv_indptr = np.zeros(len(haplotypes)+1, dtype=np.int64)
+  np.cumsum(snvs_per_seq, out=snv_indptr[1:])
+  snv_positions = np.repeat(haplotype_indptr[haplotypes] - snv_indptr[:-1], snvs_per_seq) + np.arange(snv_indptr[-1])
+
+  return snv_indptr, haplotype_snv_types[snv_positions].astype(np.int32)
+
+
+def count_unique_per_bin(labels, codes, n_bins):
   """
-  # Constraint
-  con1 = {'type': 'ineq', 'fun': lambda x: x}
-  # If no data available -- set estimate to zero
-  if n_haplo==0 or n_mut==0:
-      return 0
-  # If more haployptes than mutants, no clear answer can be given (very low sampling). Hence not evaluable
-  elif n_haplo >= n_mut:
-      return np.nan
-  # Else optimize with trust-constr option to keep evaluation in feasible region
-  else:
-      x0 = 1
-      #sol = optimize.minimize(self._fmle, x0=x0, method='trust-constr', args=(nu,ns), constraints=con1)
-      # use least squares without MLE
-      sol = optimize.minimize(get_phi, x0=x0, method='trust-constr', args=(n_haplo,n_mut), constraints=con1)
-      return sol.x[0]
+  Count the number of distinct codes per bin.
+
+  :param labels: Bin label of each code.
+  :type labels: numpy.ndarray
+  :param codes: Integer codes.
+  :type codes: numpy.ndarray
+  :param n_bins: Number of bins.
+  :type n_bins: int
+  :returns: Number of distinct codes for each bin label from 0 to n_bins-1.
+  :rtype: numpy.ndarray
+  """
+  n_codes = codes.max()+1 if codes.size else 1
+  unique_pairs = pd.unique(labels.astype(np.int64)*n_codes + codes)
+  return np.bincount(unique_pairs//n_codes, minlength=n_bins)
 
 
-def infer_bin_attributes(subsample_table): 
+def infer_bin_attributes(subsample_table, snv_types): 
   """
   Infer the attributes for a bin according to the affiliated sequences.
 
-  :param subsample_table: Table containing sequence information with (date), time t and snvs (in string format).
+  :param subsample_table: Table containing sequence information with (date), time t, snvs (in string format), mutant indicator is_mut and haplotype code.
   :type subsample_table: pandas.dataFrame
-  :returns: Table containing the attributes of the bin, including: TODO
+  :param snv_types: Codes of the SNVs of all sequences in the bin.
+  :type snv_types: numpy.ndarray
+  :returns: Table containing the attributes of the bin, including: TODO (phi is inferred for all bins at once in calculate_phi_per_bin)
   :rtype: dict
   """
 
-  from_t = subsample_table['t'].dropna().min()
-  to_t = subsample_table['t'].dropna().max()
+  # work on the underlying arrays, the caller removes sequences without t
+  t = subsample_table['t'].values
+
+  from_t = t.min()
+  to_t = t.max()
   d = to_t-from_t+1 
-  N_seq = len(subsample_table)
-  num_mut = N_seq - (subsample_table['snvs'] == "").sum()
-  haplos = set(subsample_table['snvs'])
+  N_seq = len(t)
+  num_mut = int(subsample_table['is_mut'].values.sum())
   #new_haplos = haplos[!haplos %in% actual_haplos]
-  n_haplos= len(haplos)
+  n_haplos= subsample_table['haplotype'].nunique(dropna=False)
   #new_haplotypes = length(new_haplos)
-  muts = set(list(chain.from_iterable(subsample_table['snvs'].str.split())))
   #new_muts = muts[!muts %in% actual_muts]
-  n_mut_types = len(muts)
+  n_mut_types = pd.unique(snv_types).size
   #n_new_muts = length(new_muts)
 
   w=1/(np.log(np.sqrt(d))+1)
-  bin_t = round(subsample_table['t'].mean())
+  bin_t = round(t.mean())
   #bin_t_mid = from_t+round((to_t-from_t)/2)
-  bin_t_sd = subsample_table['t'].std()
-  phi = optim(n_haplo=n_haplos/d, n_mut=num_mut/d)
-  #phi_2 = optim_2(n_haplo=n_haplos/d, n_mut=num_mut/d)
-  #phi_3 = optim_3(n_haplo=n_haplos/d, n_mut=num_mut/d)
+  # sample standard deviation, undefined for a single sequence
+  bin_t_sd = t.std(ddof=1) if N_seq > 1 else np.nan
 
-  return {'t': [bin_t],'t_sd': [bin_t_sd],'phi': [phi],'sampleSize': [N_seq],'num_mut': [num_mut],'daysPerBin': [d],'haplotypes': [n_haplos],'n_mut_types': [n_mut_types]}
+  return {'t': bin_t,'t_sd': bin_t_sd,'sampleSize': N_seq,'num_mut': num_mut,'daysPerBin': d,'haplotypes': n_haplos,'n_mut_types': n_mut_types}
 
 
-def binning_equal_days(seq_info_short_table, days):
+def binning_equal_days(seq_info_short_table, days, t_vals, t_max, snv_indptr, snv_types):
   
   #print("*************************\n")
   print(" ", days , " days\n")
   #print("*************************\n")
   
-  phi_per_bin_table_days = pd.DataFrame()
+  # label each sequence with its bin, bins start every days from the first t
+  from_t = t_vals[0]
+  labels = ((t_vals - from_t)//days).astype(np.int64)
+  # the last bin has to end before the maximal t
+  in_bins = from_t + (labels+1)*days - 1 < t_max
 
-  from_t=min(seq_info_short_table['t'])
-  to_t=from_t+days-1
+  # count the SNV types per bin on the SNV codes of all sequences
+  snvs_per_seq = np.diff(snv_indptr)
+  snv_in_bins = np.repeat(in_bins, snvs_per_seq)
+  n_mut_types = count_unique_per_bin(np.repeat(labels, snvs_per_seq)[snv_in_bins], snv_types[snv_in_bins], n_bins=labels.max()+1)
 
-  while to_t < max(seq_info_short_table['t']):
-    subsample_table = seq_info_short_table[(seq_info_short_table['t']>=from_t) & (seq_info_short_table['t']<=to_t)]
-    # Add check for empty df
-    if not subsample_table.empty:
-      phi_per_bin = infer_bin_attributes(subsample_table)
-      phi_per_bin.update({"binning": "eq_days_" + str(days)}) 
-      phi_per_bin_table_days = pd.concat([phi_per_bin_table_days,pd.DataFrame(phi_per_bin)], ignore_index=True) 
+  subsample_table = seq_info_short_table[in_bins]
+  labels = labels[in_bins]
 
-    # next bin
-    from_t+=days
-    to_t+=days
+  # aggregate the attributes of all bins at once (empty bins do not occur as groups)
+  bins = subsample_table.groupby(labels, sort=True)
+  t_agg = bins['t'].agg(['min', 'max', 'mean', 'std', 'count'])
 
+  phi_per_bin_table_days = pd.DataFrame({'t': np.round(t_agg['mean']).astype(np.int64),
+                                         't_sd': t_agg['std'],
+                                         'sampleSize': t_agg['count'],
+                                         'num_mut': bins['is_mut'].sum(),
+                                         'daysPerBin': t_agg['max']-t_agg['min']+1,
+                                         'haplotypes': bins['haplotype'].nunique()})
+  phi_per_bin_table_days['n_mut_types'] = n_mut_types[phi_per_bin_table_days.index]
+  phi_per_bin_table_days['binning'] = "eq_days_" + str(days)
 
-  return phi_per_bin_table_days
+  return phi_per_bin_table_days.reset_index(drop=True)
 
 
-def binning_equal_size(seq_info_short_table, s):
+def binning_equal_size(seq_info_short_table, s, t_vals, t_max, snv_indptr, snv_types):
   
   #print("*************************\n")
   print(" ", s , " sequences\n")
   #print("*************************\n")
 
-  # just in case, re-index the df
-  seq_info_short_table = seq_info_short_table.reset_index()
-  
-  phi_per_bin_table_size = pd.DataFrame()
+  phi_per_bin_rows = []
+  n_seqs = len(t_vals)
   
   from_t=0
   to_t=0
   actual_index = 0
   
-  while (to_t < max(seq_info_short_table['t'])) & ((actual_index+s) <= len(seq_info_short_table)):
+  while (to_t < t_max) & ((actual_index+s) <= n_seqs):
     
     #CHECK AGAIN or rather start at one t and add as many seqences from here? 
     #fastest way (numpy) to get the first occurrence of value "from"
-    actual_index = seq_info_short_table['t'].values.searchsorted(from_t)
-    subsample_table= seq_info_short_table.iloc[actual_index:min(actual_index+s, len(seq_info_short_table))]
+    actual_index = np.searchsorted(t_vals, from_t)
+    end_index = min(actual_index+s, n_seqs)
     #actual_index <- actual_index + s
-    to_t=max(subsample_table['t'])
+    # t is sorted, so the last sequence of the bin has the maximal t
+    to_t=t_vals[end_index-1]
     
     #TODO: maybe also subsample if one day has more than seq sequences? 
     # if bin is just a subset of one day, take all of the day
     if from_t == to_t:
-      subsample_table = seq_info_short_table[seq_info_short_table['t'] == to_t] 
+      end_index = np.searchsorted(t_vals, to_t, side='right')
     
-  
-    phi_per_bin = infer_bin_attributes(subsample_table)
+    subsample_table = seq_info_short_table.iloc[actual_index:end_index]
+    phi_per_bin = infer_bin_attributes(subsample_table, snv_types[snv_indptr[actual_index]:snv_indptr[end_index]])
     phi_per_bin.update({"binning": "eq_size_" + str(s)}) 
 
-    #phi_per_bin_table_size = phi_per_bin_table_size.append(phi_per_bin, ignore_index=True)
-    phi_per_bin_table_size = pd.concat([phi_per_bin_table_size,pd.DataFrame(phi_per_bin)], ignore_index=True)
+    phi_per_bin_rows.append(phi_per_bin)
   
     from_t=to_t+1
-  return phi_per_bin_table_size
+  return pd.DataFrame(phi_per_bin_rows)
 
 
 
@@ -204,7 +318,21 @@ def calculate_phi_per_bin(seq_info_short_table, seqs_per_bin, days_per_bin):
 
   minDate = min(seq_info_short_table['date'].dropna())
 
-  phi_per_bin_table = pd.DataFrame()
+  # remove sequences without t and sort by t once, instead of for every bin and binning
+  seq_info_short_table = seq_info_short_table.dropna(subset=['t']).sort_values('t', kind='stable').reset_index(drop=True)
+  t_vals = seq_info_short_table['t'].values
+  t_max = t_vals[-1]
+
+  # factorize haplotypes and single SNVs once, to count them per bin on integer codes
+  # (the SNV strings are only compared and split per distinct haplotype)
+  haplotypes, haplotype_snvs = pd.factorize(seq_info_short_table['snvs'])
+  # mark mutant sequences once, to count them per bin without comparing strings
+  seq_info_short_table = seq_info_short_table.assign(haplotype=haplotypes.astype(np.int32),
+                                                     is_mut=np.asarray(haplotype_snvs != '', dtype=np.int8)[haplotypes])
+  snv_indptr, snv_types = factorize_snvs(haplotypes, haplotype_snvs)
+
+  # collect the tables of all binnings and concatenate them once at the end
+  phi_per_bin_tables = []
 
   if days_per_bin == 0:
      print("No days per bins are used.")
@@ -216,7 +344,7 @@ def calculate_phi_per_bin(seq_info_short_table, seqs_per_bin, days_per_bin):
       days_per_bin = [7, 10, 14]
 
   for days in days_per_bin:
-    phi_per_bin_table =  pd.concat([phi_per_bin_table,binning_equal_days(seq_info_short_table, days)])
+    phi_per_bin_tables.append(binning_equal_days(seq_info_short_table, days, t_vals, t_max, snv_indptr, snv_types))
 
   if seqs_per_bin == 0:
      print("No sequences per bins are used.")
@@ -237,7 +365,7 @@ def calculate_phi_per_bin(seq_info_short_table, seqs_per_bin, days_per_bin):
     seq_info.index -= min(seq_info.index) 
     
     # Fill all missing dates with zero sequences for rolling sum
-    seqs_per_week = pd.Series([0] * max(seq_info_short_table.t))
+    seqs_per_week = pd.Series([0] * t_max)
     seqs_per_week.iloc[seq_info.index] = seq_info.sequences
     seqs_per_week = seqs_per_week.rolling(7).sum()
 
@@ -251,16 +379,24 @@ def calculate_phi_per_bin(seq_info_short_table, seqs_per_bin, days_per_bin):
     seqs_per_bin = [seq_perc_2, seq_perc_5, week_mean]
 
   for s in seqs_per_bin:
-    #phi_per_bin_table = phi_per_bin_table.append(binning_equal_size(seq_info_short_table, s))
-    phi_per_bin_table = pd.concat([phi_per_bin_table,binning_equal_size(seq_info_short_table, s)])
+    phi_per_bin_tables.append(binning_equal_size(seq_info_short_table, s, t_vals, t_max, snv_indptr, snv_types))
+
+  phi_per_bin_table = pd.concat(phi_per_bin_tables, ignore_index=True) if phi_per_bin_tables else pd.DataFrame()
   
+  # infer phi for all bins at once, solving each distinct combination of haplotypes, mutants and days (e.g. from different binnings) only once
+  if not phi_per_bin_table.empty:
+    bin_counts, bin_index = np.unique(phi_per_bin_table[['haplotypes', 'num_mut', 'daysPerBin']].values.astype(np.int64), axis=0, return_inverse=True)
+    phi = optim_batch(n_haplo=bin_counts[:,0]/bin_counts[:,2], n_mut=bin_counts[:,1]/bin_counts[:,2])
+    phi_per_bin_table.insert(2, 'phi', phi[bin_index])
+
   # remove invalid phi estimates
   phi_per_bin_table = phi_per_bin_table.dropna().reset_index(drop=True)
 
   # if table is not empty, set date
   if not phi_per_bin_table.empty: 
     #calculate date from min date adding t days
-    phi_per_bin_table['date'] = pd.to_timedelta(phi_per_bin_table['t'], 'days') + pd.to_datetime(minDate) 
+    base_date = np.datetime64(pd.Timestamp(minDate).to_datetime64(), 'D')
+    phi_per_bin_table['date'] = base_date + phi_per_bin_table['t'].values.astype(np.int64).astype('timedelta64[D]')
     
     #sort by date
     phi_per_bin_table = phi_per_bin_table.sort_values(by='date')
@@ -14,7 +14,7 @@ def get_seq_info_per_day(seq_info_short_table):
                           #TODO
                           #mut_sequences = pd.NamedAgg(column ='index', aggfunc=lambda s: s[s not ""].),
                           # count number of haplotypes (unique sequences)
-                          n_haplos = pd.NamedAgg(column ='snvs', aggfunc=lambda s: s.nunique()),
+                          n_haplos = pd.NamedAgg(column ='snvs', aggfunc='nunique'),
                           # count number of unique SNVs in all sequences
                           n_mut_types = pd.NamedAgg(column ='snvs', aggfunc=(lambda s: s.apply(str.split).explode().nunique())))
 
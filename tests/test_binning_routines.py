@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import phi.binning_routines as bin
+
+# ratios r = n_haplo/n_mut from tiny to nearly degenerate
+RATIOS = np.concatenate([np.logspace(-9, -1, 9), [0.5, np.log(2), 0.9, 1-1e-3, 1-1e-4, 1-1e-5, 1-1e-6]])
+
+
+@pytest.mark.parametrize("n_mut", [1., 7.5, 250.])
+def test_optim_matches_brentq(n_mut):
+  for r in RATIOS:
+    expected = bin.optim(r*n_mut, n_mut, solver='brentq')
+    assert bin.optim(r*n_mut, n_mut) == pytest.approx(expected, rel=1e-8)
+
+
+@pytest.mark.parametrize("n_mut", [1., 7.5, 250.])
+def test_optim_batch_matches_brentq(n_mut):
+  expected = [bin.optim(r*n_mut, n_mut, solver='brentq') for r in RATIOS]
+  np.testing.assert_allclose(bin.optim_batch(RATIOS*n_mut, np.full(RATIOS.size, n_mut)), expected, rtol=1e-8)
+
+
+def test_optim_batch_not_evaluable():
+  np.testing.assert_array_equal(bin.optim_batch([0., 1., 2., 3.], [3., 0., 2., 1.]), [0., 0., np.nan, np.nan])